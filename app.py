@@ -1,40 +1,20 @@
-import io
+import collections
+import hashlib
+import itertools
 import json
-import requests
 import threading
-from PIL import Image, ImageTk
+from PIL import ImageTk
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog, messagebox
 import torch
-from transformers import CLIPProcessor, CLIPModel
+import common
+from common import (
+    BATCH_SIZE, MODEL_PATH, CACHE_VERSION, session, get_image_urls, split_scan_halves,
+    open_cache, cache_get, cache_put, cache_commit, close_cache, prefetch_downloads,
+    decode_image, decode_images, build_image_encoder, encode_images, classify_pages, cover_ranges
+)
 
-MODEL_ID = "clip-model"
-clip_model = None
-clip_processor = None
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-def classify(image_bytes: bytes) -> dict:
-    try:
-        image = Image.open(io.BytesIO(image_bytes))
-        texts = [
-            "a photo of a newspaper cover with a title and masthead",
-            "a photo of an internal page with articles and blocks of body text (not title and masthead)",
-            "a photo of an internal page full of advertisements or announcements (not title and masthead)",
-            "a photo of an internal page with a large illustration or photograph (not title and masthead)",
-            "a photo of a table of contents or an editorial page (not title and masthead)"
-        ]
-        inputs = clip_processor(text=texts, images=image, return_tensors="pt", padding=True).to(device)
-        with torch.no_grad():
-            outputs = clip_model(**inputs)
-            logits_per_image = outputs.logits_per_image
-            prob = logits_per_image.softmax(dim=1).cpu().numpy().flatten()
-        best = prob.argmax()
-        return {
-            "prob": float(prob[best]),
-            "is_cover": bool(best == 0)
-        }
-    except Exception as e:
-        return {"error": f"Błąd przetwarzania obrazu: {e}"}
+LOG_FLUSH_INTERVAL_MS = 500
 
 class ManifestApp:
     def __init__(self, root):
@@ -69,8 +49,12 @@ class ManifestApp:
         self.button2 = ttk.Button(self.frame, text="Rozpocznij Analizę", command=self.start_search, state=tk.DISABLED)
         self.button2.grid(row=1, column=3, padx=5)
 
+        self.skip_cache_var = tk.BooleanVar(value=False)
+        self.skip_cache_check = ttk.Checkbutton(self.frame, text="Analizuj od nowa (pomiń zapisane wyniki)", variable=self.skip_cache_var, state=tk.DISABLED)
+        self.skip_cache_check.grid(row=2, column=1, sticky=tk.W, pady=5)
+
         self.button3 = ttk.Button(self.frame, text="Edytuj i Zapisz Manifest", command=self.open_editor, state=tk.DISABLED)
-        self.button3.grid(row=2, column=1, columnspan=3, sticky=tk.E, pady=5)
+        self.button3.grid(row=2, column=2, columnspan=2, sticky=tk.E, pady=5)
 
         self.progress_frame = ttk.Frame(root, padding="0 10 10 10")
         self.progress_frame.pack(fill=tk.X)
@@ -86,13 +70,22 @@ class ManifestApp:
         self.total_pages = 0
         self.manifest = None
         self.analysis_results = []
+        self.log_lines = collections.deque()
+        self.last_progress = None
 
         self.log("Wklej link do manifestu, a następnie kliknij 'Pobierz informacje'.")
         self.log("Jeśli skany zawierają po dwie strony, zaznacz opcję 'Skan dwustronicowy'.")
+        self.flush_logs()
 
     def log(self, message):
-        self.log_box.insert(tk.END, message + "\n")
-        self.log_box.see(tk.END)
+        self.log_lines.append(message)
+
+    def flush_logs(self):
+        if self.log_lines:
+            lines = [self.log_lines.popleft() for _ in range(len(self.log_lines))]
+            self.log_box.insert(tk.END, "\n".join(lines) + "\n")
+            self.log_box.see(tk.END)
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self.flush_logs)
 
     def toggle_ui(self, state):
         is_manifest_loaded = self.total_pages > 0
@@ -104,6 +97,7 @@ class ManifestApp:
         self.start_entry.config(state=tk.DISABLED if state == tk.DISABLED or not is_manifest_loaded else tk.NORMAL)
         self.end_entry.config(state=tk.DISABLED if state == tk.DISABLED or not is_manifest_loaded else tk.NORMAL)
         self.split_scan_check.config(state=tk.DISABLED if state == tk.DISABLED or not is_manifest_loaded else tk.NORMAL)
+        self.skip_cache_check.config(state=tk.DISABLED if state == tk.DISABLED or not is_manifest_loaded else tk.NORMAL)
 
         is_analysis_done = bool(self.analysis_results)
         self.button3.config(state=tk.DISABLED if state == tk.DISABLED or not is_analysis_done else tk.NORMAL)
@@ -132,7 +126,7 @@ class ManifestApp:
 
         try:
             self.log(f"\nPobieranie informacji z manifestu: {url}")
-            response = requests.get(url, timeout=20)
+            response = session.get(url, timeout=20)
             response.raise_for_status()
             self.manifest = response.json()
             self.canvases = self.manifest.get('sequences', [{}])[0].get('canvases', [])
@@ -175,10 +169,15 @@ class ManifestApp:
         self.toggle_progress_bar(True)
         self.progress_bar['value'] = 0
         self.progress_percent.config(text="0%")
+        self.last_progress = 0
         threading.Thread(target=self.run_search, args=(start_page, end_page), daemon=True).start()
 
     def run_search(self, start_page, end_page):
         is_split_scan = self.is_split_scan_var.get()
+        use_cache = not self.skip_cache_var.get()
+        if common.image_encoder is None:
+            self.log("Przygotowywanie modelu do analizy obrazów...")
+            common.image_encoder = build_image_encoder(self.log, "default")
         self.log("\n" + "="*80)
         self.log(f"Rozpoczynam analizę stron od {start_page} do {end_page}")
         if is_split_scan:
@@ -187,12 +186,14 @@ class ManifestApp:
         start_index = start_page - 1
         end_index = end_page
         canvases_to_analyze = self.canvases[start_index:end_index]
-        total_to_process = len(canvases_to_analyze)
         
+        cache_prefix = f"{CACHE_VERSION}:{'split' if is_split_scan else 'full'}:"
+        cache = open_cache(self.log)
         self.analysis_results = []
+        pages_to_download = []
         for i, canvas in enumerate(canvases_to_analyze):
             page_num = start_page + i
-            
+
             page_data = {
                 "id_text": f"Strona {page_num}",
                 "page_num": page_num,
@@ -200,54 +201,96 @@ class ManifestApp:
                 "is_cover": False,
                 "prob": 0.0
             }
-            
-            image_url_base = canvas.get('images', [{}])[0].get('resource', {}).get('service', {}).get('@id')
-            if not image_url_base:
+            self.analysis_results.append(page_data)
+
+            image_urls = get_image_urls(canvas, is_split_scan)
+            if not image_urls:
                 self.log(f"Strona {page_num}: Brak adresu URL obrazu. Pomijam.")
-                self.analysis_results.append(page_data)
                 continue
 
-            try:
-                full_image_url = f"{image_url_base.rstrip('/')}/full/1200,/0/default.jpg"
-                response = requests.get(full_image_url, timeout=30)
-                response.raise_for_status()
-                
-                if not is_split_scan:
-                    result = classify(response.content)
-                    if 'error' not in result:
-                        page_data.update(result)
-                    else:
-                        self.log(f"Błąd analizy strony {page_num}: {result['error']}")
-                else:
-                    image = Image.open(io.BytesIO(response.content))
-                    width, height = image.size
-                    mid_point = width // 2
-                    
-                    left_img_pil = image.crop((0, 0, mid_point, height))
-                    left_bytes_io = io.BytesIO()
-                    left_img_pil.save(left_bytes_io, format='JPEG')
-                    result_left = classify(left_bytes_io.getvalue())
-
-                    right_img_pil = image.crop((mid_point, 0, width, height))
-                    right_bytes_io = io.BytesIO()
-                    right_img_pil.save(right_bytes_io, format='JPEG')
-                    result_right = classify(right_bytes_io.getvalue())
-
-                    is_left_cover = result_left.get('is_cover', False)
-                    is_right_cover = result_right.get('is_cover', False)
-
-                    page_data['is_cover'] = is_left_cover or is_right_cover
-                    page_data['prob'] = max(result_left.get('prob', 0), result_right.get('prob', 0))
+            cached = cache_get(cache, cache_prefix + image_urls[0], self.log) if use_cache else None
+            if cached:
+                page_data.update(cached)
+                continue
 
-            except Exception as e:
-                self.log(f"Błąd pobierania lub przetwarzania strony {page_num}: {e}")
-            
-            self.analysis_results.append(page_data)
-            
-            progress = (i + 1) / total_to_process * 100
-            self.root.after(0, self.update_progress, progress)
+            pages_to_download.append((page_data, image_urls))
 
-        self.root.after(0, self.show_summary)
+        feature_batches = []
+        classified_pages = []
+        downloads = prefetch_downloads(pages_to_download)
+        try:
+            for batch_start in range(0, len(pages_to_download), BATCH_SIZE):
+                fetched = []
+                for page_data, image_urls, contents, error in itertools.islice(downloads, BATCH_SIZE):
+                    if error is not None:
+                        self.log(f"Błąd pobierania strony {page_data['page_num']}: {error}")
+                        continue
+
+                    content_hash = hashlib.blake2b()
+                    for content in contents:
+                        content_hash.update(content)
+                    cache_keys = [cache_prefix + image_urls[0], cache_prefix + content_hash.hexdigest()]
+                    cached = cache_get(cache, cache_keys[1], self.log) if use_cache else None
+                    if cached:
+                        page_data.update(cached)
+                        cache_put(cache, cache_keys[:1], cached, self.log)
+                        continue
+
+                    fetched.append((page_data, contents, cache_keys))
+
+                try:
+                    decoded = decode_images([content for _, contents, _ in fetched for content in contents])
+                except Exception:
+                    decoded = None
+
+                images = []
+                pages_to_classify = []
+                decoded_offset = 0
+                for page_data, contents, cache_keys in fetched:
+                    try:
+                        if decoded is not None:
+                            page_images = decoded[decoded_offset:decoded_offset + len(contents)]
+                        else:
+                            page_images = [decode_image(content) for content in contents]
+                        if is_split_scan and len(page_images) == 1:
+                            page_images = split_scan_halves(page_images[0])
+
+                        images.extend(page_images)
+                        pages_to_classify.append((page_data, len(page_images), cache_keys))
+                    except Exception as e:
+                        self.log(f"Błąd przetwarzania strony {page_data['page_num']}: {e}")
+                    decoded_offset += len(contents)
+
+                if images:
+                    try:
+                        feature_batches.append(encode_images(images))
+                        classified_pages.extend(pages_to_classify)
+                    except Exception as e:
+                        first_page = pages_to_classify[0][0]['page_num']
+                        last_page = pages_to_classify[-1][0]['page_num']
+                        self.log(f"Błąd analizy stron {first_page}–{last_page}: {e}")
+
+                progress = int(min(batch_start + BATCH_SIZE, len(pages_to_download)) / len(pages_to_download) * 100)
+                if progress != self.last_progress:
+                    self.last_progress = progress
+                    self.root.after(0, self.update_progress, progress)
+
+            if feature_batches:
+                try:
+                    page_sizes = [count for _, count, _ in classified_pages]
+                    is_cover, prob = classify_pages(torch.cat(feature_batches), page_sizes)
+                except Exception as e:
+                    self.log(f"Błąd analizy stron: {e}")
+                else:
+                    for (page_data, _, cache_keys), page_is_cover, page_prob in zip(classified_pages, is_cover, prob):
+                        page_data['is_cover'] = page_is_cover
+                        page_data['prob'] = page_prob
+                        cache_put(cache, cache_keys, page_data, self.log)
+            cache_commit(cache, self.log)
+        finally:
+            downloads.close()
+            close_cache(cache, self.log)
+            self.root.after(0, self.show_summary)
 
     def update_progress(self, value):
         self.progress_bar['value'] = value
@@ -263,7 +306,6 @@ class ManifestApp:
             self.log("\nNie zidentyfikowano żadnej strony jako okładki w podanym zakresie.")
         else:
             self.log(f"\nZnaleziono {len(covers)} potencjalnych okładek:")
-            covers.sort(key=lambda x: x['page_num'])
             for cover in covers:
                 prob_str = f"{cover.get('prob', 0):.2%}"
                 self.log(f"- Strona {cover['page_num']:<10} | Prawdopodobieństwo: {prob_str}")
@@ -358,8 +400,7 @@ class ManifestApp:
             editor_win.destroy()
             return
         
-        cover_pages = [num for num, checked in check_state.items() if checked]
-        cover_pages.sort()
+        cover_pages = sorted(num for num, checked in check_state.items() if checked)
 
         if not cover_pages:
             self.log("Nie zaznaczono żadnych okładek. Zapisuję manifest bez pola 'structures'.")
@@ -372,17 +413,15 @@ class ManifestApp:
             if not base_id or not base_id.strip():
                 base_id = 'http://example.com/manifest'
 
+            canvas_ids = [c.get('@id') for c in self.canvases]
+            starts, ends = cover_ranges(cover_pages, self.total_pages)
+
             structures = []
-            for i, start_page in enumerate(cover_pages):
+            for i, (start_page, end_page) in enumerate(zip(starts.tolist(), ends.tolist())):
                 label = f"Wydanie rozpoczynające się od strony {start_page}"
                 range_id = f"{base_id.rstrip('/')}/range/r{i}"
-                
-                end_page = cover_pages[i+1] - 1 if i + 1 < len(cover_pages) else self.total_pages
-                
-                start_index = start_page - 1
-                end_index = end_page 
-                
-                range_canvas_ids = [c['@id'] for c in self.canvases[start_index:end_index] if '@id' in c]
+
+                range_canvas_ids = [canvas_id for canvas_id in canvas_ids[start_page - 1:end_page] if canvas_id is not None]
 
                 if range_canvas_ids:
                     structures.append({
@@ -416,14 +455,11 @@ class ManifestApp:
         editor_win.destroy()
 
 if __name__ == "__main__":
-    MODEL_PATH = "clip-model"
-    
     print(f"Ładowanie modelu: {MODEL_PATH}")
     
     try:
-        clip_model = CLIPModel.from_pretrained(MODEL_PATH).to(device)
-        clip_processor = CLIPProcessor.from_pretrained(MODEL_PATH)
-        print(f"\nModel został załadowany i działa na: {device.upper()}")
+        common.load_model()
+        print(f"\nModel został załadowany i działa na: {common.device.upper()}")
 
         root = tk.Tk()
         app = ManifestApp(root)
@@ -1,62 +1,31 @@
-import io
+import hashlib
+import itertools
 import json
 import logging
-import requests
 import argparse
-from PIL import Image
 import torch
-from transformers import CLIPProcessor, CLIPModel
 from tqdm import tqdm
+import common
+from common import (
+    BATCH_SIZE, CACHE_VERSION, MODEL_PATH, session, get_image_urls, split_scan_halves,
+    open_cache, cache_get, cache_put, cache_commit, close_cache, prefetch_downloads,
+    decode_image, decode_images, build_image_encoder, encode_images, classify_pages, cover_ranges
+)
 
 logger = logging.getLogger(__name__)
 
-MODEL_PATH = "clip-model"
-clip_model = None
-clip_processor = None
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
 def load_model():
-    global clip_model, clip_processor
     try:
         logger.info(f"Rozpoczynam ładowanie modelu z: {MODEL_PATH}")
-        clip_model = CLIPModel.from_pretrained(MODEL_PATH).to(device)
-        clip_processor = CLIPProcessor.from_pretrained(MODEL_PATH)
-        logger.info(f"Model załadowany pomyślnie, działa na: {device.upper()}")
+        common.load_model()
+        common.image_encoder = build_image_encoder(logger.warning, "reduce-overhead")
+        logger.info(f"Model załadowany pomyślnie, działa na: {common.device.upper()}")
         return True
     except Exception as e:
         logger.critical(f"KRYTYCZNY BŁĄD: Nie udało się załadować modelu z folderu '{MODEL_PATH}'.")
         logger.exception(e)
         return False
 
-def classify(image_bytes: bytes) -> dict:
-    try:
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        
-        texts = [
-            "a photo of a newspaper cover with a title and masthead",
-            "a photo of an internal page with articles and blocks of body text (not title and masthead)",
-            "a photo of an internal page full of advertisements or announcements (not title and masthead)",
-            "a photo of an internal page with a large illustration or photograph (not title and masthead)",
-            "a photo of a table of contents or an editorial page (not title and masthead)"
-        ]
-
-        inputs = clip_processor(text=texts, images=image, return_tensors="pt", padding=True).to(device)
-        with torch.no_grad():
-            outputs = clip_model(**inputs)
-            logits_per_image = outputs.logits_per_image
-            is_cover = logits_per_image.argmax(-1).item() == 0
-            
-        return {"is_cover": bool(is_cover)}
-    except Exception:
-        raise
-
-def get_full_image_url(canvas: dict, size: str = "1200,") -> str:
-    try:
-        service_id = canvas['images'][0]['resource']['service']['@id']
-        return f"{service_id.rstrip('/')}/full/{size}/0/default.jpg"
-    except (KeyError, IndexError):
-        return None
-
 def get_id_from_canvas(canvas: dict) -> str:
     try:
         service_id = canvas['images'][0]['resource']['service']['@id']
@@ -64,10 +33,10 @@ def get_id_from_canvas(canvas: dict) -> str:
     except (KeyError, IndexError):
         return None
 
-def analyze_manifest(manifest_url: str, is_split_scan: bool, start_page: int, end_page: int):
+def analyze_manifest(manifest_url: str, is_split_scan: bool, start_page: int, end_page: int, use_cache: bool = True):
     logger.info(f"\nPobieranie manifestu z: {manifest_url}")
     try:
-        response = requests.get(manifest_url, timeout=30)
+        response = session.get(manifest_url, timeout=30)
         response.raise_for_status()
         manifest = response.json()
         canvases = manifest.get('sequences', [{}])[0].get('canvases', [])
@@ -95,48 +64,102 @@ def analyze_manifest(manifest_url: str, is_split_scan: bool, start_page: int, en
         logger.info("Tryb analizy: Skan dwustronicowy (obrazy będą dzielone na pół)")
 
     cover_pages_indices = []
-    
-    for i, canvas in enumerate(tqdm(canvases_to_analyze, desc="Analiza stron")):
+    cache_prefix = f"{CACHE_VERSION}:{'split' if is_split_scan else 'full'}:"
+    cache = open_cache(logger.warning)
+
+    pages_to_download = []
+    for i, canvas in enumerate(canvases_to_analyze):
         current_page_index = start_index + i
-        image_url = get_full_image_url(canvas, size="1200,")
-        if not image_url:
+        image_urls = get_image_urls(canvas, is_split_scan)
+        if not image_urls:
             logger.warning(f"Brak URL obrazu dla strony {current_page_index + 1}. Pomijam.")
             continue
-        
-        try:
-            response = requests.get(image_url, timeout=45)
-            response.raise_for_status()
-            image_bytes = response.content
-
-            is_cover_found = False
-            if not is_split_scan:
-                result = classify(image_bytes)
-                if result.get("is_cover"):
-                    is_cover_found = True
-            else:
-                image = Image.open(io.BytesIO(image_bytes))
-                width, height = image.size
-                mid_point = width // 2
-                
-                left_img_pil = image.crop((0, 0, mid_point, height))
-                with io.BytesIO() as left_bytes_io:
-                    left_img_pil.save(left_bytes_io, format='JPEG')
-                    result_left = classify(left_bytes_io.getvalue())
-                
-                right_img_pil = image.crop((mid_point, 0, width, height))
-                with io.BytesIO() as right_bytes_io:
-                    right_img_pil.save(right_bytes_io, format='JPEG')
-                    result_right = classify(right_bytes_io.getvalue())
-                
-                if result_left.get("is_cover") or result_right.get("is_cover"):
-                    is_cover_found = True
-            
-            if is_cover_found:
+
+        cached = cache_get(cache, cache_prefix + image_urls[0], logger.warning) if use_cache else None
+        if cached:
+            if cached["is_cover"]:
                 cover_pages_indices.append(current_page_index)
+            continue
 
-        except Exception as e:
-            logger.error(f"Błąd przy przetwarzaniu strony {current_page_index + 1} (URL: {image_url})")
-            logger.exception(e)
+        pages_to_download.append((current_page_index, image_urls))
+
+    feature_batches = []
+    classified_pages = []
+    downloads = prefetch_downloads(pages_to_download)
+    try:
+        with tqdm(total=len(pages_to_download), desc="Analiza stron") as progress:
+            for batch_start in range(0, len(pages_to_download), BATCH_SIZE):
+                fetched = []
+                for current_page_index, image_urls, contents, error in itertools.islice(downloads, BATCH_SIZE):
+                    if error is not None:
+                        logger.error(f"Błąd przy pobieraniu strony {current_page_index + 1} (URL: {image_urls[0]})", exc_info=error)
+                        continue
+
+                    content_hash = hashlib.blake2b()
+                    for content in contents:
+                        content_hash.update(content)
+                    cache_keys = [cache_prefix + image_urls[0], cache_prefix + content_hash.hexdigest()]
+                    cached = cache_get(cache, cache_keys[1], logger.warning) if use_cache else None
+                    if cached:
+                        if cached["is_cover"]:
+                            cover_pages_indices.append(current_page_index)
+                        cache_put(cache, cache_keys[:1], cached, logger.warning)
+                        continue
+
+                    fetched.append((current_page_index, image_urls, contents, cache_keys))
+
+                try:
+                    decoded = decode_images([content for _, _, contents, _ in fetched for content in contents])
+                except Exception:
+                    decoded = None
+
+                images = []
+                pages_to_classify = []
+                decoded_offset = 0
+                for current_page_index, image_urls, contents, cache_keys in fetched:
+                    try:
+                        if decoded is not None:
+                            page_images = decoded[decoded_offset:decoded_offset + len(contents)]
+                        else:
+                            page_images = [decode_image(content) for content in contents]
+                        if is_split_scan and len(page_images) == 1:
+                            page_images = split_scan_halves(page_images[0])
+
+                        images.extend(page_images)
+                        pages_to_classify.append((current_page_index, len(page_images), cache_keys))
+                    except Exception as e:
+                        logger.error(f"Błąd przy przetwarzaniu strony {current_page_index + 1} (URL: {image_urls[0]})")
+                        logger.exception(e)
+                    decoded_offset += len(contents)
+
+                if images:
+                    try:
+                        feature_batches.append(encode_images(images))
+                        classified_pages.extend(pages_to_classify)
+                    except Exception as e:
+                        first_page = pages_to_classify[0][0] + 1
+                        last_page = pages_to_classify[-1][0] + 1
+                        logger.error(f"Błąd przy klasyfikacji stron {first_page}-{last_page}")
+                        logger.exception(e)
+
+                progress.update(min(BATCH_SIZE, len(pages_to_download) - batch_start))
+
+        if feature_batches:
+            try:
+                page_sizes = [count for _, count, _ in classified_pages]
+                is_cover, prob = classify_pages(torch.cat(feature_batches), page_sizes)
+            except Exception as e:
+                logger.error("Błąd przy klasyfikacji stron")
+                logger.exception(e)
+            else:
+                for (page_index, _, cache_keys), page_is_cover, page_prob in zip(classified_pages, is_cover, prob):
+                    if page_is_cover:
+                        cover_pages_indices.append(page_index)
+                    cache_put(cache, cache_keys, {"is_cover": page_is_cover, "prob": page_prob}, logger.warning)
+        cache_commit(cache, logger.warning)
+    finally:
+        downloads.close()
+        close_cache(cache, logger.warning)
 
     return cover_pages_indices, canvases
 
@@ -166,14 +189,16 @@ def main():
     parser.add_argument("--split-scan", action="store_true", help="Użyj, jeśli skany zawierają dwie strony obok siebie (będą dzielone na pół).")
     parser.add_argument("--start", type=int, default=1, help="Numer strony, od której rozpocząć analizę.")
     parser.add_argument("--end", type=int, default=None, help="Numer strony, na której zakończyć analizę (włącznie). Domyślnie do końca.")
+    parser.add_argument("--no-cache", action="store_true", help="Pomiń zapisane wyniki i przeanalizuj wszystkie strony od nowa.")
     
     args = parser.parse_args()
-    logger.info(f"Aplikacja uruchomiona z argumentami: URL={args.url}, Output={args.output}, SplitScan={args.split_scan}, Start={args.start}, End={args.end}")
+    logger.info(f"Aplikacja uruchomiona z argumentami: URL={args.url}, Output={args.output}, SplitScan={args.split_scan}, Start={args.start}, End={args.end}, NoCache={args.no_cache}")
 
     if not load_model():
         exit(1)
     
-    cover_indices, all_canvases = analyze_manifest(args.url, args.split_scan, args.start, args.end)
+    cover_indices, all_canvases = analyze_manifest(args.url, args.split_scan, args.start, args.end, not args.no_cache)
+    cover_indices.sort()
     
     logger.info("")
     if not cover_indices:
@@ -181,7 +206,7 @@ def main():
         return
 
     logger.info(f"Znaleziono {len(cover_indices)} okładek:")
-    for index in sorted(cover_indices):
+    for index in cover_indices:
         logger.info(f"- Strona: {index + 1}")
 
     logger.info(f"\nGenerowanie pliku wyjściowego: {args.output}")
@@ -190,17 +215,9 @@ def main():
     
     try:
         with open(args.output, "w", encoding="utf-8") as f:
-            for i, start_idx in enumerate(sorted(cover_indices)):
+            starts, ends = cover_ranges(cover_indices, total_pages - 1)
+            for start_idx, end_idx in zip(starts.tolist(), ends.tolist()):
                 start_id = get_id_from_canvas(all_canvases[start_idx])
-                
-                if i + 1 < len(cover_indices):
-                    end_idx = sorted(cover_indices)[i+1] - 1
-                else:
-                    end_idx = total_pages - 1
-                
-                if end_idx < start_idx:
-                    end_idx = start_idx
-                    
                 end_id = get_id_from_canvas(all_canvases[end_idx])
                 
                 if start_id and end_id:
@@ -0,0 +1,332 @@
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+import torch
+from torchvision.io import ImageReadMode, decode_jpeg
+from torchvision.transforms import InterpolationMode, v2
+from transformers import CLIPProcessor, CLIPModel
+
+MODEL_PATH = "clip-model"
+ONNX_MODEL_PATH = "clip-model/clip_vision_fp16.onnx"
+BATCH_SIZE = 32
+DOWNLOAD_WORKERS = 8
+IMAGE_SIZE = "448,"
+SPLIT_SCAN_IMAGE_SIZE = "672,"
+SPLIT_SCAN_REGIONS = ["pct:0,0,50,100", "pct:50,0,50,100"]
+CACHE_DIR = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "IIIF-structure"
+)
+CACHE_PATH = os.path.join(CACHE_DIR, "classification_cache.sqlite")
+TEXTS = [
+    "a photo of a newspaper cover with a title and masthead",
+    "a photo of an internal page with articles and blocks of body text (not title and masthead)",
+    "a photo of an internal page full of advertisements or announcements (not title and masthead)",
+    "a photo of an internal page with a large illustration or photograph (not title and masthead)",
+    "a photo of a table of contents or an editorial page (not title and masthead)"
+]
+clip_model = None
+clip_processor = None
+text_features = None
+image_transform = None
+image_encoder = None
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG()
+except Exception:
+    turbo_jpeg = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+http_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+)
+session = requests.Session()
+session.mount("http://", http_adapter)
+session.mount("https://", http_adapter)
+
+def cache_version() -> str:
+    version = hashlib.blake2b("\n".join(TEXTS).encode("utf-8"), digest_size=8)
+    for name in ("config.json", "preprocessor_config.json"):
+        path = os.path.join(MODEL_PATH, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                version.update(f.read())
+    for name in ("model.safetensors", "pytorch_model.bin"):
+        path = os.path.join(MODEL_PATH, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    version.update(f"{device}:{turbo_jpeg is not None}:{IMAGE_SIZE}".encode("utf-8"))
+    return version.hexdigest()
+
+CACHE_VERSION = cache_version()
+
+def open_cache(log):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cache = sqlite3.connect(CACHE_PATH)
+        cache.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, is_cover INTEGER, prob REAL)")
+        return cache
+    except (OSError, sqlite3.Error) as e:
+        log(f"Nie udało się otworzyć pamięci podręcznej wyników, analiza bez niej: {e}")
+        return None
+
+def cache_get(cache, key: str, log) -> dict:
+    if cache is None:
+        return None
+    try:
+        row = cache.execute("SELECT is_cover, prob FROM results WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        log(f"Błąd odczytu pamięci podręcznej wyników: {e}")
+        return None
+    return {"is_cover": bool(row[0]), "prob": row[1]} if row else None
+
+def cache_put(cache, keys: list, result: dict, log):
+    if cache is None:
+        return
+    try:
+        cache.executemany(
+            "INSERT OR REPLACE INTO results (key, is_cover, prob) VALUES (?, ?, ?)",
+            [(key, result["is_cover"], result["prob"]) for key in keys]
+        )
+    except sqlite3.Error as e:
+        log(f"Błąd zapisu pamięci podręcznej wyników: {e}")
+
+def cache_commit(cache, log):
+    if cache is None:
+        return
+    try:
+        cache.commit()
+    except sqlite3.Error as e:
+        log(f"Błąd zapisu pamięci podręcznej wyników: {e}")
+
+def close_cache(cache, log):
+    if cache is None:
+        return
+    try:
+        cache.close()
+    except sqlite3.Error as e:
+        log(f"Błąd zamykania pamięci podręcznej wyników: {e}")
+
+def supports_region_by_pct(service: dict) -> bool:
+    profile = service.get("profile")
+    features = list(service.get("extraFeatures", []))
+    for entry in profile if isinstance(profile, list) else [profile]:
+        if isinstance(entry, str) and entry.endswith(("level2", "level2.json")):
+            return True
+        if isinstance(entry, dict):
+            features.extend(entry.get("supports", []))
+    return "regionByPct" in features
+
+def get_image_urls(canvas: dict, is_split_scan: bool) -> list:
+    try:
+        service = canvas['images'][0]['resource']['service']
+        service_id = service['@id'].rstrip('/')
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return []
+
+    if not is_split_scan:
+        return [f"{service_id}/full/{IMAGE_SIZE}/0/default.jpg"]
+    if supports_region_by_pct(service):
+        return [f"{service_id}/{region}/{IMAGE_SIZE}/0/default.jpg" for region in SPLIT_SCAN_REGIONS]
+    return [f"{service_id}/full/{SPLIT_SCAN_IMAGE_SIZE}/0/default.jpg"]
+
+def download_image(url: str) -> bytes:
+    response = session.get(url, timeout=45)
+    response.raise_for_status()
+    return response.content
+
+def jpeg_scaling_factor(width: int, height: int):
+    target = clip_processor.image_processor.size["shortest_edge"]
+    factors = [
+        (num, denom) for num, denom in turbo_jpeg.scaling_factors
+        if num <= denom and -(-min(width, height) * num // denom) >= target
+    ]
+    return min(factors, key=lambda factor: factor[0] / factor[1]) if factors else None
+
+def prefetch_downloads(pages: list):
+    pending = queue.Queue()
+    for page_number, (_, urls) in enumerate(pages):
+        for url_number, url in enumerate(urls):
+            pending.put((page_number, url_number, url))
+    downloads = queue.Queue(maxsize=2 * BATCH_SIZE)
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                page_number, url_number, url = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = (page_number, url_number, download_image(url), None)
+            except Exception as e:
+                result = (page_number, url_number, None, e)
+            while not stop.is_set():
+                try:
+                    downloads.put(result, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+
+    for _ in range(DOWNLOAD_WORKERS):
+        threading.Thread(target=worker, daemon=True).start()
+
+    contents = [[None] * len(urls) for _, urls in pages]
+    errors = [None] * len(pages)
+    remaining = [len(urls) for _, urls in pages]
+    try:
+        for _ in range(sum(remaining)):
+            page_number, url_number, content, error = downloads.get()
+            contents[page_number][url_number] = content
+            errors[page_number] = errors[page_number] or error
+            remaining[page_number] -= 1
+            if not remaining[page_number]:
+                page, urls = pages[page_number]
+                yield page, urls, None if errors[page_number] else contents[page_number], errors[page_number]
+                contents[page_number] = None
+    finally:
+        stop.set()
+
+def decode_image(image_bytes: bytes) -> torch.Tensor:
+    if device == "cpu" and turbo_jpeg is not None:
+        width, height, _, _ = turbo_jpeg.decode_header(image_bytes)
+        scaling_factor = jpeg_scaling_factor(width, height)
+        array = turbo_jpeg.decode(image_bytes, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+        return torch.from_numpy(array).permute(2, 0, 1)
+    data = torch.frombuffer(bytearray(image_bytes), dtype=torch.uint8)
+    return decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+
+def decode_images(images_bytes: list) -> list:
+    if device == "cpu":
+        return [decode_image(image_bytes) for image_bytes in images_bytes]
+    data = [torch.frombuffer(bytearray(image_bytes), dtype=torch.uint8) for image_bytes in images_bytes]
+    return decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+
+def split_scan_halves(image: torch.Tensor) -> list:
+    mid_point = image.shape[-1] // 2
+    return [image[:, :, :mid_point], image[:, :, mid_point:]]
+
+def build_image_transform():
+    image_processor = clip_processor.image_processor
+    crop_size = image_processor.crop_size
+    return v2.Compose([
+        v2.Resize(image_processor.size["shortest_edge"], interpolation=InterpolationMode.BICUBIC, antialias=True),
+        v2.CenterCrop((crop_size["height"], crop_size["width"])),
+        v2.ToDtype(clip_model.dtype, scale=True),
+        v2.Normalize(mean=image_processor.image_mean, std=image_processor.image_std)
+    ])
+
+def build_onnx_encoder():
+    compute_stream = torch.cuda.Stream()
+    onnx_session = ort.InferenceSession(ONNX_MODEL_PATH, providers=[(
+        "CUDAExecutionProvider",
+        {"enable_cuda_graph": True, "user_compute_stream": str(compute_stream.cuda_stream)}
+    )])
+    crop_size = clip_processor.image_processor.crop_size
+    static_input = torch.zeros((BATCH_SIZE, 3, crop_size["height"], crop_size["width"]), dtype=torch.float16, device=device)
+    static_output = torch.empty((BATCH_SIZE, clip_model.config.projection_dim), dtype=torch.float16, device=device)
+
+    binding = onnx_session.io_binding()
+    binding.bind_input("pixel_values", "cuda", 0, np.float16, tuple(static_input.shape), static_input.data_ptr())
+    binding.bind_output("image_features", "cuda", 0, np.float16, tuple(static_output.shape), static_output.data_ptr())
+
+    def encode(pixel_values):
+        compute_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(compute_stream):
+            features = []
+            for chunk in pixel_values.split(BATCH_SIZE):
+                static_input[:len(chunk)].copy_(chunk)
+                onnx_session.run_with_iobinding(binding)
+                features.append(static_output[:len(chunk)].clone())
+            features = torch.cat(features)
+        compute_stream.synchronize()
+        return features
+
+    encode(static_input)
+    return encode
+
+def build_image_encoder(log, compile_mode: str):
+    if device != "cuda":
+        return clip_model.get_image_features
+
+    if ort is not None and os.path.exists(ONNX_MODEL_PATH) and "CUDAExecutionProvider" in ort.get_available_providers():
+        try:
+            return build_onnx_encoder()
+        except Exception as e:
+            log(f"Nie udało się uruchomić modelu ONNX, używam PyTorch: {e}")
+
+    compiled = torch.compile(clip_model.get_image_features, mode=compile_mode, fullgraph=True)
+
+    def encoder(pixel_values):
+        count = len(pixel_values)
+        padding = -count % BATCH_SIZE
+        if padding:
+            pixel_values = torch.cat([pixel_values, pixel_values.new_zeros((padding, *pixel_values.shape[1:]))])
+        return compiled(pixel_values=pixel_values)[:count]
+
+    crop_size = clip_processor.image_processor.crop_size
+    dummy = torch.zeros((BATCH_SIZE, 3, crop_size["height"], crop_size["width"]), dtype=clip_model.dtype, device=device)
+    try:
+        with torch.no_grad():
+            encoder(pixel_values=dummy)
+        return encoder
+    except Exception as e:
+        log(f"Nie udało się skompilować modelu, używam trybu standardowego: {e}")
+        return clip_model.get_image_features
+
+def load_model():
+    global clip_model, clip_processor, text_features, image_transform
+    clip_model = CLIPModel.from_pretrained(MODEL_PATH).to(device)
+    if device == "cuda":
+        clip_model = clip_model.half()
+    else:
+        clip_model = torch.ao.quantization.quantize_dynamic(clip_model, {torch.nn.Linear}, dtype=torch.qint8)
+    clip_processor = CLIPProcessor.from_pretrained(MODEL_PATH)
+
+    text_inputs = clip_processor.tokenizer(
+        TEXTS, return_tensors="pt", padding="max_length", max_length=clip_model.config.text_config.max_position_embeddings
+    ).to(device)
+    with torch.no_grad():
+        features = clip_model.get_text_features(**text_inputs)
+        text_features = features / features.norm(dim=-1, keepdim=True) * clip_model.logit_scale.exp()
+    image_transform = build_image_transform()
+
+def encode_images(images: list) -> torch.Tensor:
+    pixel_values = torch.stack([image_transform(image) for image in images])
+    with torch.no_grad():
+        image_features = image_encoder(pixel_values=pixel_values)
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
+def classify_pages(image_features: torch.Tensor, page_sizes: list):
+    with torch.no_grad():
+        logits_per_image = image_features @ text_features.T
+        best = logits_per_image.argmax(dim=1)
+        prob = logits_per_image.float().softmax(dim=1).gather(1, best.unsqueeze(1)).squeeze(1)
+        results = torch.stack([prob, best.float()], dim=1).cpu().numpy()
+
+    page_offsets = np.cumsum([0] + page_sizes[:-1])
+    is_cover = np.logical_or.reduceat(results[:, 1] == 0, page_offsets)
+    prob = np.maximum.reduceat(results[:, 0], page_offsets)
+    return is_cover.tolist(), prob.tolist()
+
+def cover_ranges(cover_pages: list, last_page: int):
+    starts = np.asarray(cover_pages, dtype=np.int64)
+    ends = np.empty_like(starts)
+    ends[:-1] = starts[1:] - 1
+    ends[-1:] = last_page
+    return starts, np.maximum(ends, starts)
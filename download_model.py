@@ -1,6 +1,5 @@
-from huggingface_hub import hf_hub_download
+from huggingface_hub import snapshot_download
 import os
-from tqdm import tqdm
 
 MODEL_ID = "laion/CLIP-ViT-H-14-laion2B-s32B-b79K"
 SAVE_DIRECTORY = "clip-model"
@@ -9,24 +8,26 @@ os.makedirs(SAVE_DIRECTORY, exist_ok=True)
 
 files_to_download = [
     "config.json",
-    "pytorch_model.bin",  
+    "model.safetensors",
     "preprocessor_config.json",
     "vocab.json",
     "merges.txt"
 ]
 
 
-for filename in tqdm(files_to_download, desc="Pobierane pliki"):
-    try:
-        hf_hub_download(
-            repo_id=MODEL_ID,
-            filename=filename,
-            local_dir=SAVE_DIRECTORY,
-            local_dir_use_symlinks=False,  
-            resume_download=True         
-        )
-    except Exception as e:
-        print(f"\nBŁĄD: Nie udało się pobrać pliku {filename}. Szczegóły: {e}")
-        exit(1) 
-
+print(f"Pobieranie plików modelu {MODEL_ID}...")
+try:
+    snapshot_download(
+        repo_id=MODEL_ID,
+        local_dir=SAVE_DIRECTORY,
+        allow_patterns=files_to_download,
+        max_workers=8
+    )
+except Exception as e:
+    print(f"\nBŁĄD: Nie udało się pobrać plików modelu. Szczegóły: {e}")
+    exit(1) 
 
+missing_files = [filename for filename in files_to_download if not os.path.exists(os.path.join(SAVE_DIRECTORY, filename))]
+if missing_files:
+    print(f"\nBŁĄD: Brak plików modelu w repozytorium {MODEL_ID}: {', '.join(missing_files)}")
+    exit(1)
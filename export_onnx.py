@@ -0,0 +1,38 @@
+import torch
+from transformers import CLIPModel
+
+MODEL_PATH = "clip-model"
+ONNX_MODEL_PATH = "clip-model/clip_vision_fp16.onnx"
+
+
+class ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+if not torch.cuda.is_available():
+    print("BŁĄD: Eksport modelu FP16 wymaga karty graficznej z obsługą CUDA.")
+    exit(1)
+
+print(f"Ładowanie modelu z: {MODEL_PATH}")
+model = CLIPModel.from_pretrained(MODEL_PATH).half().to("cuda").eval()
+image_size = model.config.vision_config.image_size
+dummy_pixel_values = torch.zeros((1, 3, image_size, image_size), dtype=torch.float16, device="cuda")
+
+print(f"Eksportowanie enkodera obrazów do: {ONNX_MODEL_PATH}")
+with torch.no_grad():
+    torch.onnx.export(
+        ImageEncoder(model),
+        (dummy_pixel_values,),
+        ONNX_MODEL_PATH,
+        opset_version=17,
+        input_names=["pixel_values"],
+        output_names=["image_features"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_features": {0: "batch"}}
+    )
+
+print(f"Enkoder obrazów został zapisany w pliku '{ONNX_MODEL_PATH}'.")